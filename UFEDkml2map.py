@@ -6,15 +6,96 @@
 Processes a KML file to generate an interactive map using Plotly.
 """
 
+import csv
+import io
+import math
+import mmap
+import multiprocessing
 import os
+import re
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.io as pio
+from plotly.offline import get_plotlyjs_version
 from lxml import etree
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from tqdm import tqdm
 import logging
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Namespace-qualified KML 2.2 tags used for tag matching
+PLACEMARK_TAG = '{http://www.opengis.net/kml/2.2}Placemark'
+NAME_TAG = '{http://www.opengis.net/kml/2.2}name'
+COORD_TAG = '{http://www.opengis.net/kml/2.2}coordinates'
+
+# Byte ranges handed to worker processes are wrapped in the file's own prolog and <kml> start tag
+KML_START_TAG_RE = re.compile(rb'<kml\b[^>]*>')
+KML_ROOT_CLOSE = b'</kml>'
+PLACEMARK_END = b'</Placemark>'
+CONTAINER_TAG_RE = re.compile(rb'</?(?:Document|Folder)\b[^>]*>')
+
+# Files up to this size are parsed as a whole tree and queried with XPath
+IN_MEMORY_MAX_BYTES = 32 * 1024 * 1024
+
+# Compiled XPath queries returning one value per placemark for the in-memory parse
+KML_NAMESPACES = {'kml': 'http://www.opengis.net/kml/2.2'}
+PLACEMARKS_ALIGNED_XPATH = etree.XPath(
+    'count(//kml:Placemark[count(kml:name/text()) != 1 or count(kml:Point/kml:coordinates/text()) != 1]) = 0',
+    namespaces=KML_NAMESPACES)
+PLACEMARK_NAMES_XPATH = etree.XPath('//kml:Placemark/kml:name/text()',
+                                    namespaces=KML_NAMESPACES, smart_strings=False)
+# Spell out the Point step, a nested '//' below each placemark makes libxml2 quadratic
+PLACEMARK_COORDS_XPATH = etree.XPath('//kml:Placemark/kml:Point/kml:coordinates/text()',
+                                     namespaces=KML_NAMESPACES, smart_strings=False)
+
+# Files at least this large are parsed in parallel worker processes
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+
+# ProcessPoolExecutor refuses more than 61 workers on Windows
+MAX_PROCESS_WORKERS = 61
+
+# Errors raised while parsing a malformed KML file
+PARSE_ERRORS = (etree.XMLSyntaxError, AttributeError, IndexError, ValueError)
+
+# Number of placemarks between bulk deletions of already parsed siblings
+PRUNE_INTERVAL = 10000
+
+# Plots with more points than this are sampled, aggregated or thinned out
+MAX_PLOT_POINTS = 50000
+
+# Decimal places of the coordinate grid used to aggregate density plots (~11 m)
+DENSITY_DECIMALS = 4
+
+# Names containing any of these characters have to be quoted in the CSV export
+CSV_QUOTED_CHARS = r'[,"\r\n]'
+
+# Write buffer for the csv module fallback and the HTML plot files
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Minimal page loading the plotly.js version matching the installed Plotly from the CDN
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8" /><script src="https://cdn.plot.ly/plotly-{plotlyjs_version}.min.js"></script></head>
+<body>
+<div id="plot"></div>
+<script>
+var figure = {figure};
+Plotly.newPlot("plot", figure.data, figure.layout, {{"responsive": true}});
+</script>
+</body>
+</html>
+"""
+
 # Configure logging
 log_file = 'UFEDkml2map.log'
 
@@ -70,35 +151,184 @@ def validate_kml_file(kml_file):
     logging.info(f"Validated KML file: {kml_file}")
     return kml_file
 
+def parse_coordinates(coord_strs):
+    """Convert raw 'lon,lat[,alt]' strings into longitude and latitude arrays."""
+    count = len(coord_strs)
+    if not count:
+        return np.empty(0), np.empty(0)
+    values = np.fromstring(','.join(coord_strs), sep=',')
+    # Number of values per tuple from its comma count, checked against what was actually parsed
+    sizes = np.fromiter((coords.count(',') + 1 for coords in coord_strs), dtype=np.intp, count=count)
+    if values.size != sizes.sum() or sizes.min() < 2 or sizes.max() > 3:
+        raise ValueError("Malformed coordinates in KML file")
+    if sizes.min() == sizes.max():
+        values = values.reshape(count, sizes[0])
+        return values[:, 0], values[:, 1]
+
+    # Mixed 2D/3D coordinates, index the first value of each tuple
+    starts = np.cumsum(sizes) - sizes
+    return values[starts], values[starts + 1]
+
+def build_dataframe(names, coord_strs):
+    """Build the placemark DataFrame from the names and raw coordinate strings."""
+    lons, lats = parse_coordinates(coord_strs)
+    return pd.DataFrame({
+        'name': names,
+        'longitude': lons,
+        'latitude': lats
+    }, copy=False)
+
+def parse_placemarks(source, progress=True):
+    """Stream the Placemark elements of a KML source into a DataFrame."""
+    context = etree.iterparse(source, events=('end',), tag=PLACEMARK_TAG,
+                              collect_ids=False, remove_blank_text=True, huge_tree=True)
+    names = []
+    coord_strs = []
+    placemark_count = 0
+    for event, elem in tqdm(context, desc="Parsing KML file", unit=" placemarks",
+                            mininterval=0.5, miniters=1000, smoothing=0, disable=not progress):
+        name = elem.find(NAME_TAG).text
+        coord_elem = next(elem.iterdescendants(COORD_TAG), None)
+        if coord_elem is None or not coord_elem.text:
+            raise ValueError(f"Placemark '{name}' has no coordinates")
+        coordinates = coord_elem.text.strip()
+        names.append(name)
+        coord_strs.append(coordinates)
+        elem.clear(keep_tail=True)
+        placemark_count += 1
+        if placemark_count % PRUNE_INTERVAL == 0:
+            parent = elem.getparent()
+            del parent[:parent.index(elem)]
+    return build_dataframe(names, coord_strs)
+
+def parse_placemarks_mapped(file_path):
+    """Stream the placemarks of a KML file read through a memory map."""
+    # iterparse reads from the map directly, wrapping it in BytesIO would copy the whole file
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return parse_placemarks(mm)
+
+def parse_placemarks_in_memory(file_path):
+    """Parse a KML file that fits in memory with one XPath query per column.
+
+    Returns None unless every placemark has exactly one name and one Point
+    coordinates text, as the columns could otherwise not be matched up.
+    """
+    parser = etree.XMLParser(collect_ids=False, remove_blank_text=True, huge_tree=True)
+    tree = etree.parse(file_path, parser)
+    # Every placemark must contribute exactly one name and one coordinates text to the flat lists
+    if not PLACEMARKS_ALIGNED_XPATH(tree):
+        return None
+    names = PLACEMARK_NAMES_XPATH(tree)
+    coord_strs = PLACEMARK_COORDS_XPATH(tree)
+    return build_dataframe(names, coord_strs)
+
+def split_placemark_ranges(mm, chunk_count):
+    """Split a mapped KML file into byte ranges that end on a Placemark boundary."""
+    start = mm.find(b'<Placemark')
+    if start == -1:
+        return []
+    size = len(mm)
+    ranges = []
+    for i in range(1, chunk_count):
+        end = mm.find(PLACEMARK_END, max(start, size * i // chunk_count))
+        if end == -1:
+            break
+        end += len(PLACEMARK_END)
+        ranges.append((start, end))
+        start = end
+    last = mm.rfind(PLACEMARK_END)
+    if last != -1 and last + len(PLACEMARK_END) > start:
+        ranges.append((start, last + len(PLACEMARK_END)))
+    return ranges
+
+def find_kml_prolog(mm, limit):
+    """Return the file's prolog up to and including its <kml> start tag, or None if not found."""
+    match = KML_START_TAG_RE.search(mm, 0, limit)
+    return mm[:match.end()] if match else None
+
+def parse_kml_range(file_path, prolog, start, end):
+    """Parse the placemarks within a byte range of a KML file (worker process)."""
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # The range may cut through Folder/Document elements, drop their tags to keep it well-formed
+        chunk = prolog + CONTAINER_TAG_RE.sub(b'', mm[start:end]) + KML_ROOT_CLOSE
+    try:
+        return parse_placemarks(io.BytesIO(chunk), progress=False)
+    except PARSE_ERRORS as e:
+        raise ValueError(str(e)) from None
+
+def parse_kml_parallel(file_path, workers):
+    """Parse a large KML file in worker processes, one byte range each."""
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        ranges = split_placemark_ranges(mm, workers)
+        prolog = find_kml_prolog(mm, ranges[0][0]) if ranges else None
+    if len(ranges) < 2 or prolog is None:
+        return parse_placemarks_mapped(file_path)
+    dfs = [None] * len(ranges)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(parse_kml_range, file_path, prolog, start, end): i
+                       for i, (start, end) in enumerate(ranges)}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Parsing KML file", unit=" chunks"):
+                dfs[futures[future]] = future.result()
+    except (ValueError, BrokenProcessPool) as e:
+        logging.warning(f"Parallel parsing failed ({e}), parsing the file sequentially")
+        return parse_placemarks_mapped(file_path)
+    return pd.concat(dfs, ignore_index=True)
+
 def parse_kml(file_path):
     """Parse the KML file and extract relevant data."""
     try:
-        context = etree.iterparse(file_path, events=('end',), tag='{http://www.opengis.net/kml/2.2}Placemark')
-        data = []
-        placemark_count = 0
-        for event, elem in tqdm(context, desc="Parsing KML file", unit=" placemarks"):
-            name = elem.find('.//{http://www.opengis.net/kml/2.2}name').text
-            coordinates = elem.find('.//{http://www.opengis.net/kml/2.2}coordinates').text.strip()
-            coord_parts = coordinates.split(',')
-            if len(coord_parts) == 3:
-                lon, lat, _ = coord_parts
-            else:
-                lon, lat = coord_parts
-            data.append({
-                'name': name,
-                'longitude': float(lon),
-                'latitude': float(lat)
-            })
-            elem.clear()
-            while elem.getprevious() is not None:
-                del elem.getparent()[0]
-            placemark_count += 1
-        logging.info(f"KML file parsed successfully with {placemark_count} placemarks")
-        return pd.DataFrame(data)
-    except (etree.XMLSyntaxError, AttributeError) as e:
+        file_size = os.path.getsize(file_path)
+        workers = min(os.cpu_count() or 1, MAX_PROCESS_WORKERS)
+        if file_size <= IN_MEMORY_MAX_BYTES:
+            df = parse_placemarks_in_memory(file_path)
+            if df is None:
+                logging.info("Placemark names and coordinates do not line up, parsing placemark by placemark")
+                df = parse_placemarks_mapped(file_path)
+        elif workers > 1 and file_size >= PARALLEL_MIN_BYTES:
+            df = parse_kml_parallel(file_path, workers)
+        else:
+            df = parse_placemarks_mapped(file_path)
+        logging.info(f"KML file parsed successfully with {len(df)} placemarks")
+        return df
+    except PARSE_ERRORS as e:
         logging.error(f"Error parsing KML file: {e}")
         raise ValueError(f"Error parsing KML file: {e}")
 
+def get_source_stamp(kml_file):
+    """Return the size and modification time identifying the KML file a cache was built from."""
+    stat = os.stat(kml_file)
+    return {b'source_size': str(stat.st_size).encode(), b'source_mtime_ns': str(stat.st_mtime_ns).encode()}
+
+def load_kml_data(kml_file):
+    """Load the placemarks from the Parquet cache next to the KML file, parsing it if stale."""
+    if pa is None:
+        return parse_kml(kml_file)
+
+    cache_file = kml_file + '.parquet'
+    source_stamp = get_source_stamp(kml_file)
+    if os.path.exists(cache_file):
+        try:
+            # Only trust a cache built from a file of the same size and modification time
+            metadata = pq.read_schema(cache_file).metadata or {}
+            if all(metadata.get(key) == value for key, value in source_stamp.items()):
+                df = pq.read_table(cache_file).to_pandas()
+                logging.info(f"Loaded {len(df)} placemarks from cache {cache_file}")
+                return df
+            logging.info(f"Cache file {cache_file} belongs to a different KML file, parsing it again")
+        except (OSError, pa.ArrowException) as e:
+            logging.warning(f"Ignoring unreadable cache file {cache_file}: {e}")
+
+    df = parse_kml(kml_file)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **source_stamp})
+        pq.write_table(table, cache_file, compression='zstd')
+        logging.info(f"Parsed data cached as {cache_file}")
+    except (OSError, pa.ArrowException) as e:
+        logging.warning(f"Failed to write cache file {cache_file}: {e}")
+    return df
+
 def choose_plot_type():
     """Prompt the user to choose a plot type."""
     print()
@@ -118,36 +348,85 @@ def choose_plot_type():
     logging.info(f"Plot type chosen: {plot_type}")
     return plot_type
 
+def reduce_plot_data(df, plot_type):
+    """Reduce large DataFrames to what the selected plot type needs to render."""
+    if len(df) <= MAX_PLOT_POINTS:
+        return df
+    if plot_type == "Scatter Plot":
+        reduced = df.sample(MAX_PLOT_POINTS, random_state=0).sort_index()
+    elif plot_type == "Density Plot":
+        # Aggregate points per rounded coordinate cell and weight the density by the count,
+        # coarsening the grid until the cells fit into MAX_PLOT_POINTS
+        for decimals in range(DENSITY_DECIMALS, -1, -1):
+            cells = pd.DataFrame({
+                'latitude': df['latitude'].round(decimals),
+                'longitude': df['longitude'].round(decimals)
+            })
+            reduced = cells.groupby(['latitude', 'longitude']).size().reset_index(name='count')
+            if len(reduced) <= MAX_PLOT_POINTS:
+                break
+        else:
+            # Even whole degrees are too many cells, keep the busiest ones
+            reduced = reduced.nlargest(MAX_PLOT_POINTS, 'count')
+    elif plot_type == "Lines Plot":
+        # Keep every n-th point so the track stays in chronological order
+        step = math.ceil(len(df) / MAX_PLOT_POINTS)
+        reduced = df.iloc[::step]
+    else:
+        return df
+    logging.info(f"Reduced {len(df)} points to {len(reduced)} for {plot_type}")
+    return reduced
+
 def create_map(df, plot_type):
     """Create the appropriate plot based on the plot type selected."""
+    df = reduce_plot_data(df, plot_type)
+    # float32 keeps ~7 significant digits, under a metre, which is plenty for the map but
+    # must not leak into the CSV export or the cache
+    df = df.astype({'longitude': np.float32, 'latitude': np.float32})
     if plot_type == "Scatter Plot":
-        fig = px.scatter_mapbox(df, lat="latitude", lon="longitude", hover_name="name",
-                                zoom=3)
+        fig = px.scatter_map(df, lat="latitude", lon="longitude", hover_name="name",
+                             zoom=3)
     elif plot_type == "Density Plot":
-        fig = px.density_mapbox(df, lat="latitude", lon="longitude", hover_name="name",
-                                zoom=3)
+        if 'count' in df:
+            fig = px.density_map(df, lat="latitude", lon="longitude", z="count",
+                                 zoom=3)
+        else:
+            fig = px.density_map(df, lat="latitude", lon="longitude", hover_name="name",
+                                 zoom=3)
     elif plot_type == "Lines Plot":
-        fig = px.line_geo(df, lat="latitude", lon="longitude", hover_name="name",
-                          projection="orthographic")
+        fig = px.line_map(df, lat="latitude", lon="longitude", hover_name="name",
+                          zoom=3)
     else:
         raise ValueError(f"Unknown plot type: {plot_type}")
 
-    fig.update_layout(mapbox_style="open-street-map", height=1080, width=1920)
+    fig.update_layout(map_style="open-street-map", height=1080, width=1920)
     logging.info(f"Map created: {plot_type}")
     return fig
 
-def export_plot(fig, plot_name):
-    """Export the plot to an HTML file."""
-    timestamp = datetime.now().strftime("%y%m%d%H%M%S")
+def render_plot_html(fig):
+    """Serialize the figure with orjson into a minimal HTML page."""
+    figure = pio.to_json(fig, validate=False, engine='orjson')
+    return HTML_TEMPLATE.format(plotlyjs_version=get_plotlyjs_version(), figure=figure)
+
+def build_plot_html(df, plot_type):
+    """Create the map for a plot type and render it to HTML."""
+    return render_plot_html(create_map(df, plot_type))
+
+def write_plot_html(html, html_file):
+    """Write a rendered plot page to an HTML file."""
+    with open(html_file, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(html)
+
+def export_plot(html, plot_name, timestamp):
+    """Export the rendered plot to an HTML file."""
     html_file = f"{timestamp}_{plot_name}.html"
-    fig.write_html(html_file)
+    write_plot_html(html, html_file)
     logging.info(f"Plot saved as {html_file}")
     print(f"Plot saved as {html_file}")
 
-def get_html_filename(default_name):
+def get_html_filename(default_name, timestamp):
     """Prompt the user to input the output HTML filename."""
     print()
-    timestamp = datetime.now().strftime("%y%m%d%H%M%S")
     html_file = input(f"Output html filename (enter for '{timestamp}_{default_name}'): ")
     
     if not html_file:
@@ -157,30 +436,49 @@ def get_html_filename(default_name):
     logging.info(f"HTML filename chosen: {html_file}")
     return html_file
 
-def export_all_plots(df):
-    """Export all plot types using parallel processing."""
+def export_all_plots(df, timestamp):
+    """Export all plot types one after another."""
     plot_types = ["Scatter Plot", "Density Plot", "Lines Plot"]
-    with ThreadPoolExecutor() as executor:
-        futures = {executor.submit(create_map, df, plot_type): plot_type.lower().replace(" ", "_") for plot_type in plot_types}
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Exporting plots", unit=" plot"):
-            plot_name = futures[future]
-            try:
-                fig = future.result()
-                export_plot(fig, plot_name)
-            except Exception as e:
-                logging.error(f"Error creating plot {plot_name}: {e}")
-
-def get_output_filename(kml_file):
+    for plot_type in tqdm(plot_types, desc="Exporting plots", unit=" plot"):
+        plot_name = plot_type.lower().replace(" ", "_")
+        try:
+            export_plot(build_plot_html(df, plot_type), plot_name, timestamp)
+        except Exception as e:
+            logging.error(f"Error creating plot {plot_name}: {e}")
+
+def get_output_filename(kml_file, timestamp):
     """Generate the output filename based on the KML filename."""
     base_name = os.path.splitext(os.path.basename(kml_file))[0]
-    timestamp = datetime.now().strftime("%y%m%d%H%M%S")
     output_file = f"{timestamp}_{base_name}.csv"
     logging.info(f"Output CSV filename: {output_file}")
     return output_file
 
+def write_csv_rows(df, output_file):
+    """Write the DataFrame to a CSV file with the csv module, quoting values only where needed."""
+    if pa is not None:
+        # Format the numbers with Arrow so they read the same as in the Arrow writer's output
+        longitudes = pc.cast(pa.array(df['longitude']), pa.string()).to_pylist()
+        latitudes = pc.cast(pa.array(df['latitude']), pa.string()).to_pylist()
+    else:
+        longitudes = df['longitude'].to_numpy()
+        latitudes = df['latitude'].to_numpy()
+    with open(output_file, 'w', newline='', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(df.columns)
+        writer.writerows(zip(df['name'].to_numpy(dtype=object, na_value=''), longitudes, latitudes))
+
 def save_dataframe(df, output_file):
     """Save the DataFrame to a CSV file."""
-    df.to_csv(output_file, index=False)
+    # Arrow cannot quote only where needed, so it only writes files whose names need no quoting
+    needs_quoting = df['name'].str.contains(CSV_QUOTED_CHARS, na=False).any()
+    if pa is not None and not needs_quoting:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with open(output_file, 'wb') as f:
+            f.write((','.join(df.columns) + '\n').encode('utf-8'))
+            pacsv.write_csv(table, f, write_options=pacsv.WriteOptions(include_header=False,
+                                                                       quoting_style='none'))
+    else:
+        write_csv_rows(df, output_file)
     logging.info(f"Data saved as {output_file}")
     print(f"Data saved as {output_file}")
 
@@ -190,30 +488,34 @@ def main():
     clear_screen()
     print_header()
 
+    # One timestamp for the CSV and HTML files of this run
+    timestamp = datetime.now().strftime("%y%m%d%H%M%S")
+
     try:
         kml_file = get_kml_filename()
         validate_kml_file(kml_file)
         
-        df = parse_kml(kml_file)
+        df = load_kml_data(kml_file)
         
-        output_file = get_output_filename(kml_file)
+        output_file = get_output_filename(kml_file, timestamp)
         save_dataframe(df, output_file)
         
         plot_type = choose_plot_type()
         
         if plot_type == "All":
-            export_all_plots(df)
+            export_all_plots(df, timestamp)
         else:
             fig = create_map(df, plot_type)
             plot_name = plot_type.lower().replace(" ", "_")
-            html_file = get_html_filename(f"{plot_name}.html")
+            html_file = get_html_filename(f"{plot_name}.html", timestamp)
             
             fig.show()
-            fig.write_html(html_file)
+            write_plot_html(render_plot_html(fig), html_file)
             logging.info(f"Plot saved as {html_file}")
     except (FileNotFoundError, ValueError) as e:
         logging.error(e)
         print(e)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()